@@ -1,13 +1,17 @@
 import uuid
 import asyncio
+import itertools
+from collections import defaultdict
 from contextlib import asynccontextmanager
-import json
-from typing import Dict, Union
-from fastapi import FastAPI
+from typing import Callable, Coroutine, Dict, Optional, Protocol, Union
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from bs4 import BeautifulSoup
+from pybloom_live import ScalableBloomFilter
 import httpx
+import lxml.etree
+import orjson
 
 
 class Session(BaseModel):
@@ -19,7 +23,421 @@ class Session(BaseModel):
     max_depth: int = Field(default=1)
 
 
-all_crawlers = []
+class VisitedStore(Protocol):
+    """
+    The urls a crawling session has visited, or queued to be. Both a
+    plain `set`, which is exact, and a `ScalableBloomFilter`, which
+    trades rare false positives for a fraction of the memory, fit
+    this interface.
+    """
+
+    def add(self, url: str) -> object: ...
+
+    def __contains__(self, url: object) -> bool: ...
+
+
+class CrawlerPool:
+    """
+    An autoscaled pool of crawler tasks for a single crawling session.
+    Rather than running a fixed number of crawlers, the pool grows
+    while urls are backing up in the queue and the crawled hosts can
+    take more requests, halves when the crawled servers start failing,
+    and can rate limit how many urls the crawlers may start per
+    minute.
+
+    Parameters
+    ----------
+    spawn : Callable[[], Coroutine]
+        A factory returning a new crawler coroutine to run as a task.
+
+    task_group : asyncio.TaskGroup
+        The session's task group, which the crawler tasks are created
+        in.
+
+    url_queue : asyncio.Queue
+        The session's url queue, used to measure the backlog of work.
+
+    backoff : Dict[str, Dict[str, Union[int, float, asyncio.Semaphore]]]
+        The crawler shared per host backoff dictionary, whose
+        consecutive failure counts signal that the pool should scale
+        down.
+
+    min_concurrency : int
+        The fewest crawlers the pool will scale down to.
+
+    desired_concurrency : int
+        The number of crawlers the pool starts with, and settles back
+        to when the queue is empty.
+
+    max_concurrency : int
+        The most crawlers the pool will scale up to.
+
+    max_tasks_per_minute : Optional[int]
+        The maximum number of urls the crawlers may start per minute,
+        enforced with a token bucket. By default the crawlers aren't
+        rate limited, leaving the per host connection limits and the
+        backoff to pace them.
+
+    scale_interval : float
+        The time in seconds between scaling decisions.
+
+    Notes
+    -----
+    Crawlers are never cancelled to scale down, as that would lose the
+    url they are working on. Instead they call `retire` before taking
+    a new url from the queue, and exit if the pool has more crawlers
+    than its current concurrency. The pool only grows while no host is
+    at its connection limit and the token bucket has a token to spare,
+    as crawlers added beyond that would only queue up behind the
+    others. The pool also counts the crawlers working on a url,
+    setting its `idle` event when there are none, so a stopped session
+    knows when its queue can be drained.
+    """
+
+    def __init__(
+        self,
+        spawn: Callable[[], Coroutine],
+        task_group: asyncio.TaskGroup,
+        url_queue: asyncio.Queue,
+        backoff: Dict[str, Dict[str, Union[int, float, asyncio.Semaphore]]],
+        min_concurrency: int = 1,
+        desired_concurrency: int = 2,
+        max_concurrency: int = 50,
+        max_tasks_per_minute: Optional[int] = None,
+        scale_interval: float = 0.5,
+    ):
+        self.spawn = spawn
+        self.task_group = task_group
+        self.url_queue = url_queue
+        self.backoff = backoff
+        self.min_concurrency = min_concurrency
+        self.desired_concurrency = desired_concurrency
+        self.max_concurrency = max_concurrency
+        self.scale_interval = scale_interval
+        self.concurrency = desired_concurrency
+        self.active = 0
+        self.workers = set()
+
+        # Crawlers working on a url, so a stop can wait for them
+        self.busy = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        # Token bucket holding up to a second's worth of tasks
+        self.rate = None
+        if max_tasks_per_minute is not None:
+            self.rate = max_tasks_per_minute / 60
+            self.capacity = max(1.0, self.rate)
+            self.tokens = self.capacity
+            self.refilled = asyncio.get_running_loop().time()
+
+    async def run(self):
+        """
+        Keeps the number of crawlers at the pool's concurrency,
+        adjusting it every scale interval until cancelled, at which
+        point all the crawlers are cancelled too.
+        """
+        failures = self.failures()
+        try:
+            while True:
+                while self.active < self.concurrency:
+                    self.add_worker()
+                await asyncio.sleep(self.scale_interval)
+
+                previous_failures = failures
+                failures = self.failures()
+                backlog = self.url_queue.qsize()
+
+                if failures > previous_failures:
+                    # Servers are struggling, halve the crawlers
+                    self.concurrency = max(
+                        self.min_concurrency, self.concurrency // 2
+                    )
+                elif (
+                    failures == 0
+                    and backlog > self.active
+                    and self.has_capacity()
+                ):
+                    # Requests are succeeding and work is backing up
+                    self.concurrency = min(
+                        self.max_concurrency, self.concurrency + 1
+                    )
+                elif backlog == 0:
+                    # Settle back once the backlog has cleared
+                    self.concurrency = max(
+                        self.desired_concurrency, self.concurrency - 1
+                    )
+        finally:
+            print(f"Cancelling {len(self.workers)} crawlers.")
+            for worker in self.workers:
+                worker.cancel()
+            await asyncio.gather(*self.workers, return_exceptions=True)
+            print("Cancelled all session crawlers.")
+
+    def failures(self) -> int:
+        """
+        Returns the consecutive failures summed across all the hosts
+        being crawled.
+        """
+        return sum(
+            host["consecutive_failures"] for host in self.backoff.values()
+        )
+
+    def has_capacity(self) -> bool:
+        """
+        Returns True if another crawler could start a request right
+        away, because no host is at its connection limit and the
+        token bucket isn't empty.
+        """
+        if any(host["sem"].locked() for host in self.backoff.values()):
+            return False
+        if self.rate is not None:
+            self.refill()
+            return self.tokens >= 1
+        return True
+
+    def add_worker(self):
+        """
+        Starts a new crawler task and tracks it in the pool.
+        """
+        worker = self.task_group.create_task(self.spawn())
+        self.active += 1
+        self.workers.add(worker)
+        worker.add_done_callback(self.remove_worker)
+
+    def remove_worker(self, worker: asyncio.Task):
+        """
+        Stops tracking a finished crawler. Crawlers only finish by
+        retiring, when they've already been discounted, or by being
+        cancelled with the rest of the session.
+        """
+        self.workers.discard(worker)
+
+    def retire(self) -> bool:
+        """
+        Called by a crawler before it takes a new url, returns True
+        if the crawler should exit because the pool has scaled down.
+        """
+        if self.active > self.concurrency:
+            self.active -= 1
+            return True
+        return False
+
+    def start_task(self):
+        """
+        Called by a crawler when it takes a url from the queue.
+        """
+        self.busy += 1
+        self.idle.clear()
+
+    def finish_task(self):
+        """
+        Called by a crawler when it has finished with a url, setting
+        the idle event once no crawler is working on one.
+        """
+        self.busy -= 1
+        if self.busy == 0:
+            self.idle.set()
+
+    async def throttle(self):
+        """
+        Waits until the token bucket allows another url to be
+        started, keeping the pool under its maximum tasks per minute.
+        Returns straight away if the pool isn't rate limited.
+        """
+        if self.rate is None:
+            return
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def refill(self):
+        """
+        Adds the tokens accrued since the token bucket was last
+        refilled, up to its capacity.
+        """
+        now = asyncio.get_running_loop().time()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.refilled) * self.rate
+        )
+        self.refilled = now
+
+
+class LinkCollector:
+    """
+    A parser target that collects the links to a host while lxml
+    parses a page. As a target, lxml hands it the parse events rather
+    than building a document tree, and only the element start events
+    are requested, so text, comments and every non-anchor element are
+    skipped without being stored.
+
+    Parameters
+    ----------
+    host : str
+        The lowercased host that collected links must point to.
+
+    Attributes
+    ----------
+    page_url : str
+        The url of the page being parsed, which relative links are
+        resolved against. Set it before parsing each page.
+
+    Notes
+    -----
+    Relative links are kept, and absolute links that don't mention
+    the host are dropped with a substring check before any url
+    parsing. The remaining links are resolved against the page and
+    kept only if they're http or https links to exactly the host, so
+    a host like `example.com.evil` can't pass as `example.com`. Links
+    are collected as written, less their fragment, since that's what
+    the server expects to be asked for; they're canonicalized only to
+    check them against the visited urls.
+
+    A collector and the parsers built around it can be reused for
+    page after page, since lxml parses synchronously and so one parse
+    can't interleave with another on the same event loop.
+    """
+
+    def __init__(self, host: str):
+        self.page_url = ""
+        self.host = host
+        self.links = []
+
+    def resolve(self, href: str) -> Optional[str]:
+        """
+        Returns the absolute url an href on the page points to, or
+        None if it doesn't point to the host.
+        """
+        if "://" in href and self.host not in href.lower():
+            return None
+        try:
+            parts = urlsplit(urljoin(self.page_url, href))
+        except ValueError:
+            # Malformed url, such as an unclosed IPv6 host
+            return None
+        if (
+            parts.scheme in ("http", "https")
+            and parts.netloc.lower() == self.host
+        ):
+            return parts._replace(fragment="").geturl()
+        return None
+
+    def start(self, tag: str, attrib: Dict[str, str]):
+        """
+        Records the url of an anchor linking to the host.
+        """
+        if tag != "a":
+            return
+        href = attrib.get("href")
+        if href is not None:
+            link = self.resolve(href)
+            if link is not None:
+                self.links.append(link)
+
+    def close(self) -> list:
+        """
+        Returns the collected links once the page has been parsed,
+        ready for the next page.
+        """
+        links, self.links = self.links, []
+        return links
+
+
+class UrlQueue(asyncio.PriorityQueue):
+    """
+    A url queue that hands out the shallowest urls first, taking
+    turns between hosts at the same depth. Items are put and got as
+    `{"url": ..., "depth": ...}` dictionaries, like a plain queue, and
+    are ordered internally by `(depth, host turn, insertion order)`.
+
+    Notes
+    -----
+    Serving urls in depth order keeps the crawl breadth first, so a
+    url is always reached at its shortest depth, and the host turn
+    stops one host's links from monopolising the workers at a depth.
+    The insertion order breaks ties, keeping urls first in first out
+    within a host and depth.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.turns = defaultdict(int)
+        self.order = itertools.count()
+
+    def _put(self, item: Dict[str, Union[str, int]]):
+        key = (urlsplit(item["url"]).netloc, item["depth"])
+        turn = self.turns[key]
+        self.turns[key] += 1
+        super()._put((item["depth"], turn, next(self.order), item))
+
+    def _get(self) -> Dict[str, Union[str, int]]:
+        return super()._get()[-1]
+
+
+class MessageBroadcaster:
+    """
+    Fans a session's crawler messages out to every data stream
+    connected to it. Each subscriber gets its own bounded queue, so
+    two streams attached to the same session (for example, a client
+    reconnecting before its old stream has closed) both receive every
+    message, instead of taking turns at a single shared queue.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of messages held for each subscriber.
+
+    Notes
+    -----
+    Messages published while no stream is subscribed, such as before
+    the client's EventSource has connected, are held in a pending
+    queue that's handed to the next subscriber. All queues drop their
+    oldest message when full, so a slow subscriber never stalls the
+    crawlers or the other subscribers.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.pending = asyncio.Queue(maxsize)
+
+    def publish(self, message: dict):
+        """
+        Sends a message to every subscriber without waiting, or holds
+        it until one subscribes.
+        """
+        if not self.subscribers:
+            publish_message(self.pending, message)
+        for queue in self.subscribers:
+            publish_message(queue, message)
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        Returns a new queue that receives every published message,
+        starting with any held while nobody was subscribed.
+        """
+        if self.pending is not None:
+            queue, self.pending = self.pending, None
+        else:
+            queue = asyncio.Queue(self.maxsize)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """
+        Stops sending messages to a subscriber's queue, holding them
+        for the next subscriber if it was the last one.
+        """
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.pending = asyncio.Queue(self.maxsize)
+
+
+# Query parameters that only track visitors and never change the page
+tracking_params = {"fbclid", "gclid"}
 
 
 @asynccontextmanager
@@ -43,19 +461,25 @@ async def lifespan(app: FastAPI):
 
     Notes
     -----
-    On exit from the context, the function cancels all asyncio tasks,
-    typically crawlers or similar background tasks. It then waits for
-    all these tasks to finish cancellation, ensuring a clean shutdown.
-    This is critical for freeing up resources and avoiding potential
-    memory leaks or unfinished transactions.
+    On exit from the context, the function cancels the crawl task of
+    every active session, which in turn cancels the crawlers in the
+    session's task group. It then waits for all these tasks to finish
+    cancellation, ensuring a clean shutdown. This is critical for
+    freeing up resources and avoiding potential memory leaks or
+    unfinished transactions.
     """
     yield
+    crawls = [
+        session["task"]
+        for session in sessions.values()
+        if not session["task"].done()
+    ]
     # Print all tasks (optional, for debug purposes)
-    print(f"Cancelling {len(all_crawlers)} crawlers")
+    print(f"Cancelling {len(crawls)} crawls")
     # Cancel all tasks
-    [crawler.cancel() for crawler in all_crawlers]
+    [crawl.cancel() for crawl in crawls]
     # Wait until all tasks are cancelled
-    await asyncio.gather(*all_crawlers, return_exceptions=True)
+    await asyncio.gather(*crawls, return_exceptions=True)
     print("Cancelled all crawlers.")
 
 
@@ -100,10 +524,14 @@ async def set_session(session: Session):
     to clients via SSE.
     """
     session_key = str(uuid.uuid4())
-    async with session_lock:
-        sessions[session_key] = {"url": session.url}
-        asyncio.create_task(crawl(session_key, session.max_depth))
-        return JSONResponse(content={"key": session_key})
+
+    # The key is new and nothing awaits between these writes, so no
+    # other task can see the session half set up without the lock
+    sessions[session_key] = {"url": session.url}
+    sessions[session_key]["task"] = asyncio.create_task(
+        crawl(session_key, session.max_depth)
+    )
+    return JSONResponse(content={"key": session_key})
 
 
 @app.get("/stop_session")
@@ -122,25 +550,37 @@ async def stop_session(session_key: str):
     -------
     dict
         A confirmation message indicating the success of the
-        operation.
+        operation, or a 404 response if the session isn't running,
+        for example because its crawl has already ended.
 
     Notes
     -----
     This function first pauses the worker tasks associated with the
     session by clearing a synchronization flag (`run_flag`). It then
-    awaits a brief delay to ensure all workers have ceased operations
-    before draining the URL queue associated with the session. This
-    method ensures that all pending tasks are acknowledged and
-    cleaned, preventing any orphan tasks or resource leakage.
+    waits, for up to five seconds, until no worker is still working
+    on a url before draining the URL queue associated with the
+    session. This method ensures that all pending tasks are
+    acknowledged and cleaned, preventing any orphan tasks or resource
+    leakage. Workers still mid-request after the wait don't queue the
+    links they find, so they can't refill the drained queue.
     """
     async with session_lock:
-        url_queue = sessions[session_key]["url_queue"]
-        run_flag = sessions[session_key]["run_flag"]
+        session = sessions.get(session_key, {})
+        if "run_flag" not in session:
+            return JSONResponse(
+                status_code=404, content={"status": "Session not running"}
+            )
+        url_queue = session["url_queue"]
+        run_flag = session["run_flag"]
+        pool = session["pool"]
         # Pause the workers
         run_flag.clear()
 
-    # Wait for all the workers to wait on the run flag
-    await asyncio.sleep(2)
+    # Wait for the workers to finish the urls they're working on
+    try:
+        await asyncio.wait_for(pool.idle.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        print(f"Session: {session_key} still busy, draining anyway.")
 
     while not url_queue.empty():
         item = url_queue.get_nowait()
@@ -154,7 +594,8 @@ async def crawl(session_key: str, max_depth: int):
     Orchestrates a web crawling session using asynchronous tasks that
     navigate and process URLs from a queue. It initializes various
     components required for the crawl, such as queues for URLs and
-    messages, a set for visited URLs, and controls for task execution.
+    messages, a store of visited URLs, and controls for task
+    execution.
 
     Parameters
     ----------
@@ -170,86 +611,143 @@ async def crawl(session_key: str, max_depth: int):
     -----
     This function is a core part of initiating and managing an
     asynchronous web crawling session. Multiple crawler tasks are
-    spawned to handle the URLs concurrently. It produces the crawlers
-    shared scope, allowing them to work in tandem. When all the tasks
-    are complete it cleanly terminates the crawlers.
+    spawned to handle the URLs concurrently, inside a task group
+    scoped to the session. It produces the crawlers shared scope,
+    allowing them to work in tandem. When all the tasks are complete
+    it cleanly terminates the crawlers.
+
+    Once the crawl ends, its queue, pool and the visited urls they
+    hold are released, and the session itself is removed after it
+    has lingered long enough for a late data stream to collect its
+    messages, so memory is bounded by the active sessions.
     """
     print(f"Crawl with ID: {session_key} has begun.")
 
     # Set the configurations for the crawl
-    max_crawlers = 2
+    min_crawlers = 1
+    desired_crawlers = 2
+    max_crawlers = 50
+    max_tasks_per_minute = None  # urls started per minute, if limited
     max_attempts = 8
+    max_redirects = 5
     min_wait = 0.1  # seconds
+    max_host_connections = 4
+    max_exact_depth = 2  # deeper crawls track visited urls approximately
+    max_visits = max_host_connections  # urls each crawler works on at once
+    session_linger = 60  # seconds a finished session stays attachable
 
     # Build asynchronous objects for crawl
-    url_queue = asyncio.Queue()
+    url_queue = UrlQueue()
     run_flag = asyncio.Event()
     run_flag.set()
-    visited = set()
-    visited_lock = asyncio.Lock()
-    message_queue = asyncio.Queue()
-    backoff = {
-        "wait": 0.25,
-        "consecutive_failures": 0,
-    }
-    backoff_lock = asyncio.Lock()
-
-    # Record session data to share across endpoints
-    async with session_lock:
-        sessions[session_key]["message_queue"] = message_queue
-        sessions[session_key]["url_queue"] = url_queue
-        sessions[session_key]["run_flag"] = run_flag
-
-    # Begin the queue with the initial url
-    base_url = sessions[session_key]["url"]
-    start_url = {"url": base_url, "depth": 0}
-    await url_queue.put(start_url)
-    workers = [
-        asyncio.create_task(
-            crawler(
-                base_url,
+    visited: VisitedStore
+    if max_depth <= max_exact_depth:
+        visited = set()
+    else:
+        visited = ScalableBloomFilter(initial_capacity=100_000, error_rate=1e-4)
+    broadcaster = MessageBroadcaster(maxsize=1000)
+    backoff = defaultdict(
+        lambda: {
+            "wait": 0.25,
+            "until": 0.0,
+            "consecutive_failures": 0,
+            "sem": asyncio.Semaphore(max_host_connections),
+        }
+    )
+
+    # Share one pooled client across the crawlers to reuse connections
+    client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=max_crawlers,
+            max_keepalive_connections=desired_crawlers * 2,
+        ),
+        timeout=httpx.Timeout(10, connect=5),
+        follow_redirects=False,
+    )
+
+    base_parts = urlsplit(sessions[session_key]["url"])
+    base_url = base_parts._replace(
+        path=base_parts.path or "/", fragment=""
+    ).geturl()
+    base_host = base_parts.netloc.lower()
+    try:
+        # Scope the crawlers to the session, so none outlive it
+        async with asyncio.TaskGroup() as task_group:
+            pool = CrawlerPool(
+                lambda: crawler(
+                    base_host,
+                    url_queue,
+                    visited,
+                    broadcaster,
+                    max_depth,
+                    backoff,
+                    max_attempts,
+                    max_redirects,
+                    min_wait,
+                    run_flag,
+                    client,
+                    pool,
+                    max_visits,
+                ),
+                task_group,
                 url_queue,
-                visited,
-                visited_lock,
-                message_queue,
-                max_depth,
                 backoff,
-                backoff_lock,
-                max_attempts,
-                min_wait,
-                run_flag,
+                min_concurrency=min_crawlers,
+                desired_concurrency=desired_crawlers,
+                max_concurrency=max_crawlers,
+                max_tasks_per_minute=max_tasks_per_minute,
             )
-        )
-        for _ in range(max_crawlers)
-    ]
 
-    # Wait for the queue to empty
-    global all_crawlers
-    all_crawlers += workers
-    await url_queue.join()
-    print("End of Queue.")
-
-    # Clean up the workers
-    print(f"Cancelling {len(workers)} crawlers.")
-    for worker in workers:
-        worker.cancel()
-    await asyncio.gather(*workers, return_exceptions=True)
-    print(f"Cancelled 2 crawlers.")
+            # Record session data to share across endpoints
+            async with session_lock:
+                sessions[session_key]["broadcaster"] = broadcaster
+                sessions[session_key]["url_queue"] = url_queue
+                sessions[session_key]["run_flag"] = run_flag
+                sessions[session_key]["pool"] = pool
+
+            # Begin the queue with the initial url
+            start_url = {"url": base_url, "depth": 0}
+            visited.add(canonicalize(base_url))
+            await url_queue.put(start_url)
+            pool_task = task_group.create_task(pool.run())
+
+            # Wait for the queue to empty
+            await url_queue.join()
+            print("End of Queue.")
+
+            # Clean up the pool, the task group then awaits its workers
+            pool_task.cancel()
+    except* Exception as e:
+        print(f"Crawl with ID: {session_key} failed: {e.exceptions!r}")
+    finally:
+        # Close the shared connection pool once the crawlers are done
+        await client.aclose()
+
+        # Release the crawl's state, keeping the broadcaster for a
+        # while for a data stream that connects after the crawl ended
+        for field in ("url_queue", "run_flag", "pool"):
+            sessions[session_key].pop(field, None)
+        asyncio.get_running_loop().call_later(
+            session_linger, sessions.pop, session_key, None
+        )
     print(f"Crawl with ID: {session_key} has ended.")
 
 
 async def crawler(
-    base_url: str,
+    base_host: str,
     url_queue: asyncio.Queue,
-    visited: set,
-    visited_lock: asyncio.Lock,
-    message_queue: asyncio.Queue,
+    visited: VisitedStore,
+    broadcaster: MessageBroadcaster,
     max_depth: int,
-    backoff: Dict[str, Union[int, float]],
-    backoff_lock: asyncio.Lock,
+    backoff: Dict[str, Dict[str, Union[int, float, asyncio.Semaphore]]],
     max_attempts: int,
+    max_redirects: int,
     min_wait: float,
     run_flag: asyncio.Event,
+    client: httpx.AsyncClient,
+    pool: CrawlerPool,
+    max_visits: int,
 ):
     """
     Executes the web crawling logic asynchronously by working through
@@ -259,162 +757,304 @@ async def crawler(
 
     Parameters
     ----------
-    base_url : str
-        The root URL from which the crawling begins, used to filter
-        outbound links.
+    base_host : str
+        The host of the root URL from which the crawling begins, used
+        to filter outbound links.
 
     url_queue : asyncio.Queue
         The queue that holds URLs to be crawled, structured with URL
         and depth.
 
-    visited : set
-        A set to record URLs that have been visited to avoid
-        revisiting them.
-
-    visited_lock : asyncio.Lock
-        A lock to ensure safe modification of the visited set.
+    visited : VisitedStore
+        A set, or a Bloom filter for deep crawls, recording URLs that
+        have been visited, or queued to be, to avoid revisiting them.
+        Links are added as they're queued, so each URL is queued at
+        most once. Crawlers share it without a lock, as membership
+        checks and additions never await.
 
-    message_queue : asyncio.Queue
-        The queue used for sending back information about crawled
-        URLs.
+    broadcaster : MessageBroadcaster
+        The broadcaster used for sending back information about
+        crawled URLs to the session's data streams.
 
     max_depth : int
         The maximum depth to crawl beyond which URLs are ignored.
 
-    backoff : Dict[str, Union[int, float]]
+    backoff : Dict[str, Dict[str, Union[int, float, asyncio.Semaphore]]]
         A crawler shared dictionary managing the backoff strategy for
-        retries, with parameters like wait time and consecutive
-        failure count.
-
-    backoff_lock : asyncio.Lock
-        A lock to ensure safe access to the backoff dictionary.
+        retries of each host, with parameters like wait time and
+        consecutive failure count, and a semaphore limiting the
+        requests in flight to the host.
 
     max_attempts : int
         The maximum number of attempts to fetch a URL before giving
         up.
 
+    max_redirects : int
+        The maximum number of redirects followed in a chain, so a
+        redirect loop ends rather than bouncing between urls forever.
+
     min_wait : float
-        The minimum wait time between HTTP requests to manage server
-        load.
+        The minimum wait before each url is requested, to manage
+        server load. A crawler's urls wait concurrently, so it delays
+        each request rather than spacing them; the per host connection
+        limit and, if it's set, the pool's rate limit space them out.
 
     run_flag : asyncio.Event
         A shared flag to control the running state of all crawlers in
         a session, allowing for a global pause and resume
         functionality.
 
+    client : httpx.AsyncClient
+        The HTTP/2 client shared by all crawlers in a session, so
+        connections to the crawled hosts are pooled and reused.
+
+    pool : CrawlerPool
+        The pool running the crawler, which decides when it should
+        retire and, if it's rate limited, when it may start each url.
+
+    max_visits : int
+        The most urls the crawler works on at once. Sized to the per
+        host connection limit, since any more would only wait for a
+        connection.
+
     Notes
     -----
     This function leverages the httpx.AsyncClient for asynchronous
     HTTP requests, handling responses, and parsing links within web
-    pages using BeautifulSoup. Errors and backoff are managed based
+    pages using lxml. Errors and backoff are managed based
     on HTTP response status. The crawler adjusts its behavior
     dynamically based on errors encountered, such as backing off on
     receiving 429 Too Many Requests or server errors.
+
+    Rather than one url at a time, the crawler runs each url it
+    takes as its own task, and takes another whenever fewer than
+    `max_visits` are in flight, so a slow response or a url backing
+    off doesn't leave it idle. The tasks are scoped to the crawler,
+    which waits for them when it retires and cancels them when it's
+    cancelled.
     """
-    async with httpx.AsyncClient() as client:
+    loop = asyncio.get_running_loop()
+
+    # Reused for every page, rather than built per page. A parser's
+    # encoding is fixed when it's built, so there's one for each
+    # charset the responses declare
+    collector = LinkCollector(base_host)
+    parsers = {}
+
+    def parser_for(encoding: Optional[str]) -> lxml.etree.HTMLParser:
+        """
+        Returns the parser for pages in the given encoding, leaving
+        lxml to detect it from the page when it's None or unknown.
+        """
+        if encoding not in parsers:
+            try:
+                parsers[encoding] = lxml.etree.HTMLParser(
+                    target=collector, encoding=encoding
+                )
+            except LookupError:
+                parsers[encoding] = parser_for(None)
+        return parsers[encoding]
+
+    async def visit(next_url: Dict[str, Union[str, int]]):
+        """
+        Crawls a single url taken from the queue, marking it done.
+        """
+        # Drop urls taken after the session was stopped
+        if not run_flag.is_set():
+            url_queue.task_done()
+            return
+
+        # Skip urls above the maximum search depth
+        depth = next_url["depth"]
+        if depth > max_depth:
+            url_queue.task_done()
+            print(f"Over Max Depth: {depth}")
+            return
+
+        url = next_url["url"]
+        host = urlsplit(url).netloc.lower()
+
+        # Avoid overstressing servers
+        await asyncio.sleep(min_wait)
+
+        attempts = 0
         while True:
-            # Pause run if the flag is cleared
-            await run_flag.wait()
-            next_url = await url_queue.get()
 
-            # Skip urls above the maximum search depth
-            depth = next_url["depth"]
-            if depth > max_depth:
+            if attempts > max_attempts:
                 url_queue.task_done()
-                print(f"Over Max Depth: {depth}")
-                continue
-
-            url = next_url["url"]
-            # Skip urls that have already been visited
-            async with visited_lock:
-                if url in visited:
-                    print("Already seen URL.")
-                    url_queue.task_done()
-                    continue
-                else:
-                    visited.add(url)
-
-            # Avoid overstressing servers
-            await asyncio.sleep(min_wait)
+                print("Max attempts reached.")
+                break
+            attempts += 1
+
+            # Attempt to crawl the url
+            try:
+                async with backoff[host]["sem"]:
+                    # Wait out the host's backoff before sending, checking
+                    # for a stop every quarter second
+                    while run_flag.is_set():
+                        delay = backoff[host]["until"] - loop.time()
+                        if delay <= 0:
+                            break
+                        await asyncio.sleep(min(delay, 0.25))
+
+                    # Drop urls whose wait outlasted the session
+                    if not run_flag.is_set():
+                        url_queue.task_done()
+                        break
+                    response = await client.get(url)
+                response.raise_for_status()
+
+                # Re-calculate back off if no errors raised
+                backoff_calculator(
+                    host,
+                    backoff,
+                    failed=False,
+                    min_wait=min_wait,
+                )
+
+                # Get the links to the base host, without a tree, decoding
+                # the page with the charset its headers declare
+                collector.page_url = url
+                parser = parser_for(response.charset_encoding)
+                hrefs = lxml.etree.fromstring(response.content, parser)
+                links = dict.fromkeys(hrefs)
+
+                # Queue a message for the data stream
+                broadcaster.publish(
+                    {"visited": url, "links": list(links), "depth": depth}
+                )
+
+                # Stream the unvisited links into the queue, unless
+                # they'd be over the maximum search depth, or the
+                # session was stopped and its queue drained meanwhile
+                if depth < max_depth and run_flag.is_set():
+                    for link in links:
+                        key = canonicalize(link)
+                        if key in visited:
+                            continue
+                        visited.add(key)
+                        await url_queue.put({"url": link, "depth": depth + 1})
 
-            attempts = 0
-            while True:
+                url_queue.task_done()
+                break
+
+            except httpx.HTTPStatusError as e:
+                # Page has moved, queue its target at the same depth
+                redirects = next_url.get("redirects", 0)
+                if (
+                    e.response.has_redirect_location
+                    and redirects < max_redirects
+                ):
+                    collector.page_url = url
+                    target = collector.resolve(e.response.headers["location"])
+                    if target is not None and target != url:
+                        # A target differing from the url only in ways its
+                        # canonical form ignores shares its visited key
+                        key = canonicalize(target)
+                        if run_flag.is_set() and (
+                            key == canonicalize(url) or key not in visited
+                        ):
+                            visited.add(key)
+                            await url_queue.put(
+                                {
+                                    "url": target,
+                                    "depth": depth,
+                                    "redirects": redirects + 1,
+                                }
+                            )
+                        url_queue.task_done()
+                        break
 
-                if attempts > max_attempts:
+                print(
+                    f"Request failed: {e.response.status_code} for URL: {url}"
+                )
+                # Page is inaccessible, or a redirect not followed, skip
+                skip_codes = [400, 401, 403, 404]
+                # Page is accessible, but wait
+                backoff_codes = [429, 500, 502, 503, 504]
+                if (
+                    e.response.is_redirect
+                    or e.response.status_code in skip_codes
+                ):
+                    broadcaster.publish(
+                        {"visited": url, "links": [], "depth": depth}
+                    )
                     url_queue.task_done()
-                    print("Max attempts reached.")
                     break
-                attempts += 1
-
-                # Attempt to crawl the url
-                try:
-                    response = await client.get(url)
-                    response.raise_for_status()
-
-                    # Re-calculate back off if no errors raised
-                    await backoff_calculator(
+                elif e.response.status_code in backoff_codes:
+                    # The next attempt waits out the host's backoff
+                    backoff_calculator(
+                        host,
                         backoff,
-                        backoff_lock,
-                        failed=False,
+                        failed=True,
                         min_wait=min_wait,
                     )
-
-                    # Get the unvisited links
-                    soup = BeautifulSoup(response.text, "html.parser")
-                    links = {
-                        a["href"]
-                        for a in soup.find_all("a", href=True)
-                        if a["href"].startswith(base_url)
-                    }
-
-                    # Queue a message for the data stream
-                    await message_queue.put(
-                        {"visited": url, "links": list(links), "depth": depth}
+                    print("Backing Off")
+                else:
+                    print(f"Unhandled Error Code: {e.response.status_code}")
+                    broadcaster.publish(
+                        {"visited": url, "links": [], "depth": depth}
                     )
-
-                    # Add links to the queue
-                    async with visited_lock:
-                        links = links - visited
-                    for link in links:
-                        await url_queue.put({"url": link, "depth": depth + 1})
-
                     url_queue.task_done()
                     break
 
-                except httpx.HTTPStatusError as e:
-                    print(
-                        f"Request failed: {e.response.status_code} for URL: {url}"
-                    )
-                    # Page is inaccessible, skip
-                    skip_codes = [301, 302, 400, 401, 403, 404]
-                    # Page is accessible, but wait
-                    backoff_codes = [429, 500, 502, 503, 504]
-                    if e.response.status_code in skip_codes:
-                        await message_queue.put(
-                            {"visited": url, "links": [], "depth": depth}
-                        )
-                        url_queue.task_done()
-                        break
-                    elif e.response.status_code in backoff_codes:
-                        wait_time = await backoff_calculator(
-                            backoff,
-                            backoff_lock,
-                            failed=True,
-                            min_wait=min_wait,
-                        )
-                        print("Backing Off")
-                        await asyncio.sleep(wait_time)
-                    else:
-                        print(f"Unhandled Error Code: {e.response.status_code}")
-                        break
+            except httpx.TransportError as e:
+                # Connection failed or timed out, wait then retry
+                print(f"Request failed: {e!r} for URL: {url}")
+                backoff_calculator(
+                    host,
+                    backoff,
+                    failed=True,
+                    min_wait=min_wait,
+                )
+
+            except Exception as e:
+                # Skip a page that broke unexpectedly, such as with an
+                # undecodable body, rather than failing the session
+                print(f"Unexpected Error: {e!r} for URL: {url}")
+                broadcaster.publish(
+                    {"visited": url, "links": [], "depth": depth}
+                )
+                url_queue.task_done()
+                break
+
+    # Bound the urls in flight, freeing a slot as each one finishes
+    slots = asyncio.Semaphore(max_visits)
+
+    async def run_visit(next_url: Dict[str, Union[str, int]]):
+        try:
+            await visit(next_url)
+        finally:
+            pool.finish_task()
+            slots.release()
 
+    async with asyncio.TaskGroup() as visits:
+        while True:
+            # Exit once the urls in flight finish if the pool has
+            # scaled down
+            if pool.retire():
+                return
 
-async def backoff_calculator(
-    backoff: Dict[str, Union[int, float]],
-    backoff_lock: asyncio.Lock,
+            # Pause run if the flag is cleared
+            await run_flag.wait()
+
+            # Take a url as soon as there's a free slot for it and the
+            # rate limit allows, so it only counts as busy once it's
+            # started
+            await slots.acquire()
+            await pool.throttle()
+            next_url = await url_queue.get()
+            pool.start_task()
+            visits.create_task(run_visit(next_url))
+
+
+def backoff_calculator(
+    host: str,
+    backoff: Dict[str, Dict[str, Union[int, float, asyncio.Semaphore]]],
     failed: bool,
     min_wait: float,
-) -> int:
+    max_wait: float = 60,
+) -> float:
     """
     Adjusts the wait time dynamically based on the success or failure
     of HTTP requests, employing an exponential backoff and decay
@@ -422,13 +1062,13 @@ async def backoff_calculator(
 
     Parameters
     ----------
-    backoff : Dict[str, Union[int, float]]
-        A dictionary holding the current wait time and the count of
-        consecutive failures.
+    host : str
+        The host the HTTP request was made to.
 
-    backoff_lock : asyncio.Lock
-        A lock to ensure exclusive access to the backoff dictionary
-        during updates.
+    backoff : Dict[str, Dict[str, Union[int, float, asyncio.Semaphore]]]
+        A dictionary holding the current wait time, the time requests
+        wait until before they're sent, and the count of consecutive
+        failures for each host.
 
     failed : bool
         Indicates whether the most recent HTTP request failed.
@@ -437,34 +1077,117 @@ async def backoff_calculator(
         The minimum wait time that should be maintained after
         decaying.
 
+    max_wait : float, optional
+        The longest the wait time can grow to. Defaults to 60 seconds.
+
     Returns
     -------
-    int
+    float
         The updated wait time after adjustments.
 
     Notes
     -----
-    If an operation fails, this function doubles the wait time and
-    increments the count of consecutive failures. If the operation
-    succeeds, it applies a decay factor to the wait time (reducing it
-    by 20%) but not below the specified minimum wait time, resetting
-    the failure count. This approach helps manage request rates
-    adaptively.
-    """
-    async with backoff_lock:
-        if failed:
-            backoff["wait"] = backoff["wait"] * 2
-            backoff["consecutive_failures"] += 1
-        else:
-            if backoff["wait"] > min_wait:
-                backoff["wait"] = backoff["wait"] * 0.8
-            backoff["consecutive_failures"] = 0
+    If an operation fails, this function doubles the wait time, up to
+    the maximum, increments the count of consecutive failures, and
+    sets the time requests to the host wait until. Requests sent
+    together tend to fail together, so failures arriving before that
+    time has passed don't back off again; the wait doubles at most
+    once per window. If the operation succeeds, it applies a decay
+    factor to the wait time (reducing it by 20%) but not below the
+    specified minimum wait time, resetting the failure count. Each
+    host backs off independently, so a struggling host doesn't slow
+    the requests to healthy ones. This approach helps manage request
+    rates adaptively. The update never awaits, so it can't interleave
+    with other crawlers and needs no lock.
+    """
+    host_backoff = backoff[host]
+    now = asyncio.get_running_loop().time()
+    if failed:
+        if now >= host_backoff["until"]:
+            wait = min(host_backoff["wait"] * 2, max_wait)
+            host_backoff["wait"] = wait
+            host_backoff["until"] = now + wait
+            host_backoff["consecutive_failures"] += 1
+    else:
+        if host_backoff["wait"] > min_wait:
+            host_backoff["wait"] = host_backoff["wait"] * 0.8
+        host_backoff["consecutive_failures"] = 0
+
+    return host_backoff["wait"]
+
+
+def canonicalize(url: str) -> str:
+    """
+    Normalizes a url so that addresses pointing to the same page
+    compare equal when they're checked against the visited urls. The
+    canonical form is only a key; urls are queued and fetched as
+    written.
+
+    Parameters
+    ----------
+    url : str
+        The url to normalize.
+
+    Returns
+    -------
+    str
+        The canonical form of the url.
+
+    Notes
+    -----
+    The scheme and host are lowercased, the fragment is removed,
+    tracking parameters (`utm_*`, `fbclid` and `gclid`) are dropped,
+    the remaining query parameters are sorted, and an empty path
+    becomes `/`. Trailing slashes are kept, as `/path` and `/path/`
+    can be different pages, and a site serving one will often
+    redirect the other to it.
+    """
+    parts = urlsplit(url)
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith("utm_") and key not in tracking_params
+    )
+    path = parts.path or "/"
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            path,
+            urlencode(query),
+            "",
+        )
+    )
+
+
+def publish_message(message_queue: asyncio.Queue, message: dict):
+    """
+    Puts a message on a bounded message queue without waiting, so a
+    slow or disconnected client never stalls the crawlers.
 
-        return backoff["wait"]
+    Parameters
+    ----------
+    message_queue : asyncio.Queue
+        The bounded queue feeding one of the session's data streams.
+
+    message : dict
+        The message to send to the client.
+
+    Notes
+    -----
+    When the queue is full the oldest message is dropped to make room
+    for the new one, so the queue behaves like a ring buffer holding
+    the most recent updates.
+    """
+    try:
+        message_queue.put_nowait(message)
+    except asyncio.QueueFull:
+        message_queue.get_nowait()
+        message_queue.put_nowait(message)
 
 
 @app.get("/data_stream")
-async def data_stream(session_key: str):
+async def data_stream(session_key: str, request: Request):
     """
     A session key is provided by the client and used to connect to
     data stream that's generated by the crawl endpoint.
@@ -474,43 +1197,97 @@ async def data_stream(session_key: str):
     """
     """
     Streams live data back to the client using Server-Sent Events
-    (SSE). This endpoint connects to a message queue for a given
-    session and continuously transmits any messages received from
-    the associated crawling process.
+    (SSE). This endpoint subscribes to the message broadcaster for a
+    given session and continuously transmits any messages received
+    from the associated crawling process.
 
     Parameters
     ----------
     session_key : str
         The unique identifier for the client's session, used to
-        retrieve the appropriate message queue for the data stream.
+        retrieve the appropriate broadcaster for the data stream.
+
+    request : Request
+        The incoming request, used to detect when the client has
+        disconnected.
 
     Returns
     -------
     StreamingResponse
         An SSE stream that sends a continuous flow of messages in
-        real-time, formatted as JSON data.
+        real-time, formatted as JSON arrays of messages, or a 404
+        response if the session has been removed.
 
     Notes
     -----
     This function defines an asynchronous generator,
-    `event_generator`, which listens for new messages from the
-    message queue. Each message is formatted and sent as a data event
-    in the SSE stream. This allows the client to receive live updates
-    about the crawling progress and results.
+    `event_generator`, which listens for new messages on its own
+    subscription to the broadcaster. Messages are coalesced into
+    batches, flushed when a batch is full or its oldest message has
+    waited for the flush interval, and each batch is sent as a single
+    data event in the SSE stream. This allows the client to receive
+    live updates about the crawling progress and results without
+    paying the framing and serialization cost per message. The
+    generator stops once the client disconnects, rather than holding
+    the stream open, and then unsubscribes.
     """
     print("hi")
     async with session_lock:
-        message_queue = sessions[session_key]["message_queue"]
+        broadcaster = sessions.get(session_key, {}).get("broadcaster")
+    if broadcaster is None:
+        return JSONResponse(
+            status_code=404, content={"status": "Session not found"}
+        )
+
+    # Set the batching configurations for the stream
+    max_batch = 32
+    flush_interval = 0.1  # seconds
 
     async def event_generator():
-        while True:
-            message = await message_queue.get()
-            yield f"data: {json.dumps(message)}\n\n"
+        loop = asyncio.get_running_loop()
+        message_queue = broadcaster.subscribe()
+        batch = []
+        # Reset by the first message of each batch, and only read while
+        # a batch is pending
+        flush_at = loop.time()
+        try:
+            while True:
+                # Wait for a message, or until the current batch is due
+                timeout = max(flush_at - loop.time(), 0) if batch else 1
+                try:
+                    message = await asyncio.wait_for(
+                        message_queue.get(), timeout=timeout
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    if not batch:
+                        flush_at = loop.time() + flush_interval
+                    batch.append(message)
+                    if len(batch) < max_batch and loop.time() < flush_at:
+                        continue
+
+                # Stop streaming when the client goes away
+                if await request.is_disconnected():
+                    print(
+                        f"Data stream for Session: {session_key} disconnected."
+                    )
+                    break
+
+                if batch:
+                    yield b"data: " + orjson.dumps(batch) + b"\n\n"
+                    batch = []
+        finally:
+            broadcaster.unsubscribe(message_queue)
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=80)
+    # uvloop isn't installed on every platform, such as Windows or
+    # PyPy, where asyncio's loop is used instead
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    uvicorn.run(app, host="0.0.0.0", port=80, loop=loop, http="httptools")
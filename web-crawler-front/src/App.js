@@ -38,14 +38,16 @@ function App() {
     );
 
     eventSource.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      let link_visited = { visited: data.visited, depth: data.depth };
-      let links = data.links;
-      console.log(data);
-      for (let link of links) {
-        console.log(link);
+      // Each event carries a batch of crawler messages
+      const batch = JSON.parse(event.data);
+      let links_visited = [];
+      let links = [];
+      for (let data of batch) {
+        console.log(data);
+        links_visited.push({ visited: data.visited, depth: data.depth });
+        links.push(...data.links);
       }
-      setVisited((visited) => [...visited, link_visited]);
+      setVisited((visited) => [...visited, ...links_visited]);
       countLinks(links);
     };
 